@@ -1,156 +1,623 @@
 # analyzer/analysis_service.py
 # 런타임 의존성:
-#   - apt: ffmpeg, python3, python3-pip
-#   - pip: opencv-python-headless pillow numpy pydub requests google-generativeai
+#   - apt: ffmpeg, python3, python3-pip, libturbojpeg0
+#   - pip: av opencv-python-headless pillow numpy requests google-generativeai orjson "PyTurboJPEG<2"
 # 환경 변수:
 #   - GEMINI_API_KEY (필수)
 #   - TOPMEDIA_API_KEY (필수)
 #   - [옵션] TOPMEDIA_API_URL(기본: https://api.topmediai.com/v1/text2speech)
 #   - [옵션] TOPMEDIA_VOICE (기본: ko_female_basic)
+#   - [옵션] GEMINI_RPM (기본 60), GEMINI_BURST (기본 5), GEMINI_TPM (기본 2000000, 0이면 제한 없음)
+#   - [옵션] ANALYZER_IO_WORKERS (동시 네트워크 요청 수, 기본 16)
+#   - [옵션] ANALYZER_CACHE_DIR (기본: <tmp>/simple-api-cache), ANALYZER_CACHE_TTL (초, 기본 86400, 0이면 끔),
+#           ANALYZER_CACHE_MAX_MB (캐시 전체 크기 상한, 기본 512)
 
-import os, sys, json, time, argparse, tempfile, random, base64
+import os, sys, re, mmap, json, time, argparse, tempfile, random, base64, threading, hashlib, subprocess
+from concurrent.futures import Future, ThreadPoolExecutor
 from http.client import RemoteDisconnected
+from io import BytesIO
 from typing import Optional
+from urllib.parse import urlparse
 
+import av
 import cv2
 import numpy as np
 from PIL import Image  # noqa: F401
 import requests
-from pydub import AudioSegment
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import google.generativeai as genai
+from google.api_core import exceptions as gapi_exc
+
+try:
+    import orjson
+except ImportError:  # orjson이 없는 환경에서는 표준 json으로
+    orjson = None
+
+# PyTurboJPEG 2.x는 libjpeg-turbo 3.0+ 전용 → bullseye(libturbojpeg0 2.0.x)에선 1.x를 써야 함
+try:
+    from turbojpeg import TurboJPEG, TJSAMP_420
+except ImportError:  # 모듈이 없으면 조용히 cv2.imencode로
+    TurboJPEG = None
+_TJ = None
+if TurboJPEG is not None:
+    try:
+        _TJ = TurboJPEG()
+    except Exception as e:  # 모듈은 있는데 라이브러리 로드 실패 → 원인을 남기고 cv2.imencode로
+        sys.stderr.write(f"[analyzer] turbojpeg unavailable, falling back to cv2.imencode: {e}\n")
+
+cv2.setNumThreads(os.cpu_count() or 1)  # resize 등 OpenCV 내부 병렬화
 
 # ------------------------ 공통 유틸 ------------------------
 
+def _json_loads(s):
+    return orjson.loads(s) if orjson is not None else json.loads(s)
+
+def _json_dumpb(obj) -> bytes:
+    # 파일/표준출력은 UTF-8 바이트로 바로 씀 (orjson은 bytes를 반환하므로 decode/encode 왕복 없음)
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+def _json_dumps(obj) -> str:
+    return _json_dumpb(obj).decode("utf-8")
+
+def _print_json(obj):
+    sys.stdout.buffer.write(_json_dumpb(obj) + b"\n")
+    sys.stdout.flush()
+
+def write_json(path: str, obj: dict):
+    # 진행 표시용 (tmp/fsync 없이) — 최종 결과는 write_json_atomic으로
+    with open(path, "wb") as f:
+        f.write(_json_dumpb(obj))
+
 def write_json_atomic(path: str, obj: dict):
     tmp = path + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(obj, f, ensure_ascii=False)
+    with open(tmp, "wb") as f:
+        f.write(_json_dumpb(obj))
         f.flush()
         os.fsync(f.fileno())
     os.replace(tmp, path)
 
-def _backoff_sleep(i: int, base: float = 1.0, cap: float = 20.0):
-    wait = min(cap, base * (2 ** i)) + random.random()
+BACKOFF_FLOOR = 0.05
+
+def _remaining(deadline: float) -> float:
+    return max(0.0, deadline - time.monotonic())
+
+def _backoff_sleep(prev: float, base: float = 1.3, cap: float = 20.0, floor: float = BACKOFF_FLOOR) -> float:
+    # decorrelated jitter: 직전 대기의 3배 안에서 무작위로 → 동시에 실패한 워커들이 한꺼번에 재시도하지 않음
+    wait = min(cap, random.uniform(floor, max(prev * 3, base)))
     time.sleep(wait)
+    return wait
+
+_FENCE_RE = re.compile(r"^```(?:json)?|```$")
+# 재시도 판정: 예외 타입으로 먼저 보고, 문자열은 단어 경계가 있는 좁은 패턴으로만.
+# 레이트 리밋은 더 길게, 일시적 네트워크/서버 오류는 짧게 물러남
+RATE_LIMIT_BACKOFF_BASE = 5.0
+_RATE_LIMIT_RE = re.compile(r"\b(429|rate limit(?:ed)?|quota|resource exhausted)\b", re.I)
+_TRANSIENT_RE = re.compile(
+    r"\b(timeout|timed out|deadline exceeded|protocol error|chunked|connection (?:reset|aborted|refused)"
+    r"|remote end closed|50[0234])\b", re.I)
+_RATE_LIMIT_TYPES = (gapi_exc.ResourceExhausted, gapi_exc.TooManyRequests)
+_TRANSIENT_TYPES = (ConnectionError, TimeoutError, RemoteDisconnected,
+                    requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError,
+                    gapi_exc.ServiceUnavailable, gapi_exc.DeadlineExceeded, gapi_exc.InternalServerError)
 
 def _clean_json_text(text: str) -> str:
     if not text: return text
-    return text.strip().replace("```json", "").replace("```", "").strip()
+    text = text.strip()
+    if "```" not in text: return text  # response_schema 응답은 보통 펜스가 없음 → 정규식 생략
+    return _FENCE_RE.sub("", text).strip()
+
+class GeminiResponseError(RuntimeError):
+    # 응답은 받았는데 비었거나 JSON이 아님 → 같은 요청을 다시 보내도 소용없고,
+    # 메시지에 모델 출력이 섞이므로 아래 정규식 판정에 넣지 않음
+    pass
 
 def _is_rate_limit(e: Exception) -> bool:
-    s = str(e).lower()
-    return any(k in s for k in ["429", "rate limit", "quota", "resource exhausted"])
+    return isinstance(e, _RATE_LIMIT_TYPES) or bool(_RATE_LIMIT_RE.search(str(e)))
+
+def _is_transient(e: Exception) -> bool:
+    return isinstance(e, _TRANSIENT_TYPES) or bool(_TRANSIENT_RE.search(str(e)))
 
 def _should_retry_exception(e: Exception) -> bool:
-    if isinstance(e, (ConnectionError, TimeoutError, RemoteDisconnected, ConnectionResetError)):
-        return True
-    s = str(e).lower()
-    if any(k in s for k in ["connection", "timeout", "protocol", "chunked"]): return True
-    if _is_rate_limit(e): return True
-    return False
+    if isinstance(e, GeminiResponseError): return False
+    return _is_rate_limit(e) or _is_transient(e)
+
+def _retry_backoff_base(e: Exception, base: float) -> float:
+    return max(base, RATE_LIMIT_BACKOFF_BASE) if _is_rate_limit(e) else base
+
+# 업로드/TTS 등 네트워크 대기 작업이 같이 쓰는 풀. 동시에 나가는 요청 수의 전체 상한 역할도 함
+# (풀 안의 작업에서 다시 이 풀에 제출하지 말 것 — 풀이 꽉 차면 교착)
+IO_WORKERS = int(os.environ.get("ANALYZER_IO_WORKERS", "16"))
+_IO_POOL = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+
+# ------------------------ 디스크 캐시 ------------------------
+# 같은 영상을 재실행할 때 동일한 Gemini/TTS 요청을 다시 보내지 않도록 요청 해시로 결과를 저장
+
+CACHE_DIR = os.environ.get("ANALYZER_CACHE_DIR", os.path.join(tempfile.gettempdir(), "simple-api-cache"))
+CACHE_TTL = float(os.environ.get("ANALYZER_CACHE_TTL", "86400"))
+CACHE_MAX_BYTES = int(float(os.environ.get("ANALYZER_CACHE_MAX_MB", "512")) * 1024 * 1024)
+_SWEEP_LOCK = threading.Lock()
+_SWEPT = False
+
+def _hash_key(obj) -> str:
+    raw = json.dumps(obj, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()
+
+def _cache_path(ns: str, key: str) -> str:
+    return os.path.join(CACHE_DIR, ns, key[:2], key)
+
+def cache_get(ns: str, key: str) -> Optional[bytes]:
+    if CACHE_TTL <= 0: return None
+    p = _cache_path(ns, key)
+    try:
+        if time.time() - os.path.getmtime(p) > CACHE_TTL:
+            os.unlink(p)  # 만료된 항목은 읽는 김에 지움
+            return None
+        with open(p, "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+def _cache_sweep():
+    # 작업(프로세스)마다 첫 쓰기 전에 한 번: 만료 항목/남은 임시 파일을 지우고,
+    # 그래도 상한을 넘으면 오래된 것부터 지움 → 오래 떠 있는 컨테이너에서 /tmp가 끝없이 늘지 않게
+    now, entries, total = time.time(), [], 0
+    for root, _, names in os.walk(CACHE_DIR):
+        for name in names:
+            p = os.path.join(root, name)
+            tmp = name.endswith(".tmp")
+            try:
+                st = os.stat(p)
+                # 임시 파일은 1분 넘게 남은 것만 (다른 작업이 쓰는 중일 수 있음)
+                if now - st.st_mtime > (60 if tmp else CACHE_TTL): os.unlink(p)
+            except OSError:
+                continue
+            if tmp or now - st.st_mtime > CACHE_TTL: continue
+            entries.append((st.st_mtime, st.st_size, p))
+            total += st.st_size
+    if total <= CACHE_MAX_BYTES: return
+    entries.sort()
+    for _, size, p in entries:
+        try: os.unlink(p)
+        except OSError: continue
+        total -= size
+        if total <= CACHE_MAX_BYTES: break
+
+def cache_set(ns: str, key: str, data: bytes):
+    global _SWEPT
+    if CACHE_TTL <= 0: return
+    if not _SWEPT:
+        with _SWEEP_LOCK:
+            if not _SWEPT:
+                try: _cache_sweep()
+                except OSError: pass
+                _SWEPT = True
+    p = _cache_path(ns, key)
+    tmp = f"{p}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(p), exist_ok=True)
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, p)
+    except OSError:
+        pass  # 캐시 실패는 파이프라인을 막지 않음
+
+def _part_key(p):
+    # 프롬프트 조각을 캐시 키용으로 정규화 (이미지/파일은 내용 해시로)
+    if isinstance(p, str): return p
+    if isinstance(p, dict) and "data" in p:
+        return {"mime_type": p.get("mime_type"), "sha256": hashlib.sha256(p["data"]).hexdigest()}
+    h = getattr(p, "sha256_hash", None)
+    if isinstance(h, bytes): h = h.hex()
+    return {"file": h or getattr(p, "name", None) or repr(p)}
+
+# ------------------------ 요청 속도 제한 ------------------------
+# 429를 맞고 나서 물러나는 대신, 보내기 전에 로컬에서 기다려 한도 안에 머무름
+
+class TokenBucket:
+    def __init__(self, rate_per_sec: float, burst: float):
+        self.rate = float(rate_per_sec)
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, cost: float = 1.0):
+        if self.rate <= 0: return
+        cost = min(float(cost), self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= cost:
+                    self.tokens -= cost
+                    return
+                wait = (cost - self.tokens) / self.rate
+            time.sleep(wait)
+
+IMAGE_TOKEN_COST = 258  # Gemini 이미지 1장당 입력 토큰
+
+def _estimate_tokens(parts) -> int:
+    # 한국어 위주 프롬프트라 글자 2개당 1토큰 정도로 넉넉히 잡음
+    return sum(len(p) // 2 + 1 if isinstance(p, str) else IMAGE_TOKEN_COST for p in parts)
+
+_GEMINI_RPM = int(os.environ.get("GEMINI_RPM", "60"))
+_GEMINI_TPM = int(os.environ.get("GEMINI_TPM", "2000000"))
+_RPM_BUCKET = TokenBucket(_GEMINI_RPM / 60.0, float(os.environ.get("GEMINI_BURST", "5")))
+_TPM_BUCKET = TokenBucket(_GEMINI_TPM / 60.0, _GEMINI_TPM)
 
 # ------------------------ Gemini 래퍼(강화판) ------------------------
 
+def _content_hash(src) -> str:
+    # bytes면 바로, 경로면 청크 단위로 읽어서 (큰 영상도 메모리에 다 올리지 않음)
+    h = hashlib.blake2b(digest_size=16)
+    if isinstance(src, (bytes, bytearray)):
+        h.update(src)
+    else:
+        with open(src, "rb") as fh:
+            for chunk in iter(lambda: fh.read(1 << 20), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+GENERATION_CONFIG = {"response_mime_type": "application/json", "temperature": 0.0}
+
+# 엔드포인트별 응답 스키마
+EVENTS_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {"start": {"type": "INTEGER"}, "event_description": {"type": "STRING"}},
+        "required": ["start", "event_description"],
+    },
+}
+SCRIPT_LINE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {"text": {"type": "STRING"}, "rate": {"type": "NUMBER"}},
+    "required": ["text", "rate"],
+}
+SCRIPT_BATCH_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {"id": {"type": "STRING"}, "text": {"type": "STRING"}, "rate": {"type": "NUMBER"}},
+        "required": ["id", "text", "rate"],
+    },
+}
+
+def _gap_batch_schema(n: int) -> dict:
+    ids = [f"G{g}" for g in range(n)]
+    return {"type": "OBJECT", "properties": {g: EVENTS_SCHEMA for g in ids}, "required": ids}
+
 class ResilientGemini:
     def __init__(self, api_key: str, model_name="gemini-1.5-pro-latest",
-                 default_timeout=120.0, poll_interval=0.5, max_polls=60):
+                 default_timeout=120.0, poll_interval=5.0, max_polls=60,
+                 poll_backoff_min=0.05, poll_backoff_base=1.3):
         self.api_key = api_key
         self.model_name = model_name
         self.default_timeout = float(default_timeout)
-        self.poll_interval = float(poll_interval)
+        self.poll_interval = float(poll_interval)  # 폴링 간격 상한
         self.max_polls = int(max_polls)
+        self.poll_backoff_min = float(poll_backoff_min)
+        self.poll_backoff_base = float(poll_backoff_base)
+        self._client_lock = threading.Lock()  # 병렬 업로드 재시도가 동시에 리셋할 수 있음
+        self._upload_cache = {}  # (내용 해시, mime_type) -> 업로드된 파일 핸들의 Future
+        self._upload_lock = threading.Lock()
         self._reset_client()
 
-    def _reset_client(self):
-        genai.configure(api_key=self.api_key)
-        self.model = genai.GenerativeModel(
-            model_name=self.model_name,
-            generation_config={"response_mime_type": "application/json", "temperature": 0.0}
-        )
+    def _reset_client(self, force: bool = False):
+        # 모델 객체는 재사용; 연결 수준 오류일 때만 force로 새로 만듦 (429/쿼터는 다시 만들어도 소용없음)
+        with self._client_lock:
+            if getattr(self, "model", None) is not None and not force: return
+            genai.configure(api_key=self.api_key)
+            self.model = genai.GenerativeModel(
+                model_name=self.model_name,
+                generation_config=GENERATION_CONFIG
+            )
+
+    @staticmethod
+    def inline_image(data: bytes, mime: str = "image/jpeg") -> dict:
+        # 요청 본문에 바로 싣는 파트 → Files API 업로드/ACTIVE 폴링 없음
+        return {"mime_type": mime, "data": data}
 
-    def upload_file_retry(self, path: str, mime_type: str = None, retries=6, backoff_base=1.0):
-        last_err = None
-        for i in range(retries):
+    def upload_bytes_retry(self, data: bytes, mime_type: str, **kw):
+        # 메모리에 있는 JPEG 등을 디스크를 거치지 않고 업로드
+        return self.upload_file_retry(data, mime_type, **kw)
+
+    def upload_file_retry(self, path, mime_type: str = None, retries=6, backoff_base=1.3, deadline=None):
+        # 내용이 같은 파일(정적 중계 화면, 검은 프레임 등)은 한 번만 올리고 핸들을 재사용
+        # 같은 내용이 동시에 들어오면 먼저 온 쪽이 Future를 걸어 두고 올리며, 나머지는 그 결과를 기다림
+        h = (_content_hash(path), mime_type)
+        with self._upload_lock:
+            fut = self._upload_cache.get(h)
+            owner = fut is None
+            if owner: fut = self._upload_cache[h] = Future()
+        if not owner: return fut.result()
+        try:
+            uf = self._upload_uncached(path, mime_type, retries, backoff_base, deadline)
+        except BaseException as e:
+            with self._upload_lock:
+                self._upload_cache.pop(h, None)  # 실패는 캐시하지 않음 → 다음 호출이 다시 시도
+            fut.set_exception(e)
+            raise
+        fut.set_result(uf)
+        return uf
+
+    def delete_uploads(self):
+        # 업로드한 파일은 Files API 저장소에 48시간 남음 → 작업이 끝나면 바로 정리
+        with self._upload_lock:
+            futs, self._upload_cache = list(self._upload_cache.values()), {}
+
+        def _delete(fut):
+            try: uf = fut.result()
+            except BaseException: return  # 업로드 실패 → 지울 것 없음
+            name = getattr(uf, "name", None)
+            if not name: return
+            try: genai.delete_file(name)
+            except Exception: pass
+
+        list(_IO_POOL.map(_delete, futs))
+
+    def _call_with_retry(self, attempt, what: str, retries: int, backoff_base: float, deadline: float):
+        # 업로드/생성이 같이 쓰는 재시도 루프. 재시도 대상 오류만 삼키고, 연결 수준 오류면 클라이언트를
+        # 새로 만들고, 시도와 백오프 모두 deadline 안에서만
+        last_err, delay = None, BACKOFF_FLOOR
+        for _ in range(retries):
+            if _remaining(deadline) <= 0:
+                raise TimeoutError(f"{what}: time budget exhausted: {last_err}")
             try:
-                f = genai.upload_file(path, mime_type=mime_type)
-                name = getattr(f, "name", None)
-                if not name: return f
-                for _ in range(self.max_polls):
-                    g = genai.get_file(name)
-                    state = getattr(getattr(g, "state", None), "name", None) or getattr(g, "state", None)
-                    if str(state).upper() == "ACTIVE": return g
-                    time.sleep(self.poll_interval)
-                return g
+                return attempt()
             except Exception as e:
                 last_err = e
                 if not _should_retry_exception(e): raise
-                try: self._reset_client()
-                except Exception: pass
-                _backoff_sleep(i, base=backoff_base)
-        raise RuntimeError(f"upload_file_retry failed: {last_err}")
+                if not _is_rate_limit(e):
+                    try: self._reset_client(force=True)
+                    except Exception: pass
+                delay = _backoff_sleep(delay, base=_retry_backoff_base(e, backoff_base),
+                                       cap=min(20.0, _remaining(deadline)))
+        raise RuntimeError(f"{what} failed: {last_err}")
+
+    def _upload_uncached(self, path, mime_type, retries, backoff_base, deadline=None):
+        # 업로드 재시도 + ACTIVE 폴링 전체가 하나의 default_timeout 벽시계 한도를 나눠 씀
+        if deadline is None: deadline = time.monotonic() + self.default_timeout
 
-    def generate_json_retry(self, parts, timeout=None, retries=6, backoff_base=1.0):
+        def attempt():
+            src = BytesIO(path) if isinstance(path, (bytes, bytearray)) else path
+            f = genai.upload_file(src, mime_type=mime_type)
+            name = getattr(f, "name", None)
+            if not name: return f
+            # 빨리 ACTIVE 되는 경우는 짧게, 느린 경우는 점점 길게 (상한 poll_interval).
+            # 폴링 횟수와 별개로 남은 벽시계 한도 안에서만 기다림
+            for poll_i in range(self.max_polls):
+                g = genai.get_file(name)
+                state = getattr(getattr(g, "state", None), "name", None) or getattr(g, "state", None)
+                if str(state).upper() == "ACTIVE": return g
+                remaining = _remaining(deadline)
+                if remaining <= 0: break
+                time.sleep(min(remaining, self.poll_interval,
+                               self.poll_backoff_min * (self.poll_backoff_base ** poll_i)))
+            return g
+
+        return self._call_with_retry(attempt, "upload_file_retry", retries, backoff_base, deadline)
+
+    def generate_json_retry(self, parts, timeout=None, retries=6, backoff_base=1.3, schema=None, deadline=None):
+        # schema를 주면 응답을 그 구조의 JSON으로 강제 → 형식 오류로 비싼 멀티모달 호출을 다시 하는 일이 줄어듦
+        # timeout은 시도당이 아니라 재시도/백오프까지 포함한 전체 한도
         tmo = float(timeout or self.default_timeout)
-        last_err = None
-        for i in range(retries):
-            try:
-                resp = self.model.generate_content(parts, request_options={"timeout": tmo})
-                text = (getattr(resp, "text", None) or "").strip()
-                if not text:
-                    try:
-                        cands = getattr(resp, "candidates", None) or []
-                        if cands and getattr(cands[0], "content", None):
-                            pieces = []
-                            for p in (cands[0].content.parts or []):
-                                t = getattr(p, "text", None)
-                                if t: pieces.append(t)
-                            text = "".join(pieces).strip()
-                    except Exception:
-                        pass
-                if not text:
-                    pf = getattr(resp, "prompt_feedback", None)
-                    raise RuntimeError(f"Gemini returned empty response. Check GEMINI_API_KEY / quota / safety. prompt_feedback={pf}")
-                cleaned = _clean_json_text(text)
+        gen_cfg = {**GENERATION_CONFIG, "response_schema": schema} if schema else None
+        cache_key = _hash_key({"model": self.model_name, "parts": [_part_key(p) for p in parts], "schema": schema})
+        cached = cache_get("gemini", cache_key)
+        if cached is not None:
+            return _json_loads(cached)
+        if deadline is None: deadline = time.monotonic() + tmo
+
+        def attempt():
+            _RPM_BUCKET.acquire()
+            _TPM_BUCKET.acquire(_estimate_tokens(parts))
+            # 스트리밍으로 받아 생성과 수신을 겹침 (청크는 도착하는 대로 모음)
+            resp = self.model.generate_content(parts, stream=True, generation_config=gen_cfg,
+                                               request_options={"timeout": max(1.0, _remaining(deadline))})
+            buf = []
+            for chunk in resp:
                 try:
-                    return json.loads(cleaned)
-                except Exception as je:
-                    preview = cleaned[:400]
-                    raise RuntimeError(f"Gemini non-JSON response preview: {preview}") from je
-            except Exception as e:
-                last_err = e
-                if not _should_retry_exception(e): raise
-                try: self._reset_client()
-                except Exception: pass
-                _backoff_sleep(i, base=backoff_base)
-        raise RuntimeError(f"generate_json_retry failed: {last_err}")
+                    buf.append(chunk.text or "")
+                except ValueError:
+                    pass  # 텍스트 파트가 없는 청크(안전 필터 등)
+            text = "".join(buf).strip()
+            if not text:
+                try:
+                    cands = getattr(resp, "candidates", None) or []
+                    if cands and getattr(cands[0], "content", None):
+                        pieces = []
+                        for p in (cands[0].content.parts or []):
+                            t = getattr(p, "text", None)
+                            if t: pieces.append(t)
+                        text = "".join(pieces).strip()
+                except Exception:
+                    pass
+            if not text:
+                pf = getattr(resp, "prompt_feedback", None)
+                raise GeminiResponseError(f"Gemini returned empty response. Check GEMINI_API_KEY / safety settings. prompt_feedback={pf}")
+            cleaned = _clean_json_text(text)
+            try:
+                result = _json_loads(cleaned)
+            except Exception as je:
+                preview = cleaned[:400]
+                raise GeminiResponseError(f"Gemini non-JSON response preview: {preview}") from je
+            cache_set("gemini", cache_key, _json_dumpb(result))
+            return result
+
+        return self._call_with_retry(attempt, "generate_json_retry", retries, backoff_base, deadline)
 
 # ------------------------ 분석 파이프라인 ------------------------
 
-def extract_frames_per_second(video_path: str, fps: int = 1):
-    temp_dir = tempfile.mkdtemp(prefix="frames_")
-    cap = cv2.VideoCapture(video_path)
+INLINE_FRAME_MAX = 4 * 1024 * 1024
+INLINE_REQUEST_BUDGET = 14 * 1024 * 1024  # 요청 한도 20MB, base64 팽창(4/3) 감안
+
+def _frame_parts(R: ResilientGemini, frames):
+    # 작은 JPEG는 Files API(업로드 + ACTIVE 폴링) 없이 인라인 파트로 보내고,
+    # 요청 한도를 넘어서는 분량만 병렬 업로드. 원래 순서대로 (time, part) 반환
+    out, budget, to_upload = [None] * len(frames), INLINE_REQUEST_BUDGET, []
+    for idx, f in enumerate(frames):
+        size = len(f["data"])
+        if size <= INLINE_FRAME_MAX and size <= budget:
+            out[idx] = (f["time"], R.inline_image(f["data"]))
+            budget -= size
+        else:
+            to_upload.append(idx)
+    handles = _IO_POOL.map(lambda idx: R.upload_bytes_retry(frames[idx]["data"], "image/jpeg"), to_upload)
+    for idx, uf in zip(to_upload, handles):
+        out[idx] = (frames[idx]["time"], uf)
+    return out
+
+FRAME_SIZE = 224  # 짧은 변 기준 px. Gemini 비전은 작은 타일로 토큰화해서 더 크게 보내도 바이트만 늘어남
+JPEG_QUALITY = 60
+ENCODE_WORKERS = 4
+DEDUP_HAMMING = 5  # 직전 유지 프레임과 dHash 거리가 이보다 작으면 같은 장면으로 보고 버림
+
+MOTION_PERCENTILE = 70  # get_major_key_events에는 움직임 점수 상위 30%(+국소 최대)만 보냄
+
+def _dhash(img) -> int:
+    # 9x8 회색조에서 가로로 이웃한 픽셀의 대소 비교 64비트 → 전체 밝기 변화(페이드, 노출)에 aHash보다 덜 흔들림
+    g = cv2.cvtColor(cv2.resize(img, (9, 8), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+    return int.from_bytes(np.packbits((g[:, 1:] > g[:, :-1]).ravel()).tobytes(), "big")
+
+def _encode_jpeg(img, quality: int = JPEG_QUALITY) -> bytes:
+    # libturbojpeg SIMD 인코더를 직접 호출 (bgr 입력 그대로). TurboJPEG 2.x API에는 허프만 최적화
+    # 플래그가 없어 결과가 몇 % 더 큼 → 224px 프레임에선 인코드 속도 쪽을 택함
+    if _TJ is not None:
+        return _TJ.encode(img, quality=int(quality), jpeg_subsample=TJSAMP_420)
+    # 허프만 테이블 최적화로 같은 화질에서 몇 % 더 작게 (메타데이터는 imencode가 쓰지 않음)
+    params = [int(cv2.IMWRITE_JPEG_QUALITY), int(quality), int(cv2.IMWRITE_JPEG_OPTIMIZE), 1,
+              int(cv2.IMWRITE_JPEG_PROGRESSIVE), 0]
+    ok, buf = cv2.imencode(".jpg", img, params)
+    if not ok: raise RuntimeError("JPEG 인코딩 실패")
+    return buf.tobytes()
+
+def _target_size(w: int, h: int, short_side: int):
+    scale = short_side / min(h, w)
+    return max(1, round(w * scale)), max(1, round(h * scale))
+
+def _sample_frames_av(video_path: str, fps: int, emit, short_side: int = FRAME_SIZE) -> float:
+    # FFmpeg 프레임 스레딩으로 디코드하고, bgr 변환은 샘플 시점 프레임에만.
+    # 1fps 샘플 간격은 보통 GOP보다 짧아서 시점마다 seek하면 오히려 재디코드가 늘어남
+    # 읽기 전용 mmap으로 열면 페이지 캐시 관리는 커널에 맡기고 seek은 오프셋 접근으로 처리됨
+    with open(video_path, "rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+            av.open(mm, mode="r") as container:
+        stream = container.streams.video[0]
+        stream.thread_type = "AUTO"
+        tb = float(stream.time_base)
+        t0 = (stream.start_time or 0) * tb
+        k, last_t = 0, 0.0
+        for frame in container.decode(stream):
+            if frame.pts is None: continue  # 타임스탬프 없는 프레임은 위치를 알 수 없음
+            t = frame.pts * tb - t0
+            last_t = max(last_t, t)
+            if t * fps + 1e-6 < k: continue
+            # 축소는 bgr 변환과 같은 swscale 패스에서 → 원본 해상도 bgr 배열을 만들지 않음
+            w, h = _target_size(frame.width, frame.height, short_side)
+            emit(t, frame.reformat(width=w, height=h, format="bgr24", interpolation="AREA").to_ndarray())
+            k = int(t * fps) + 1
+        if k == 0:
+            # pts가 전혀 없는 스트림(일부 raw/VFR 컨테이너) → 프레임 번호 기반 OpenCV 경로로
+            raise RuntimeError("no timestamped frames from PyAV")
+        if stream.duration: return float(stream.duration * tb)
+        if container.duration: return container.duration / av.time_base
+        return last_t
+
+def _seek_frames_cv2(cap, duration_sec: float, fps: int, emit) -> bool:
+    # 샘플 시점마다 POS_MSEC로 바로 이동 → 샘플 수만큼만 demux/디코드 (전 프레임 grab 대신)
+    # 첫 seek부터 실패하면 False를 돌려 grab 루프로; 중간 실패는 거기까지만 쓴다
+    for k in range(int(duration_sec * fps) + 1):
+        if not cap.set(cv2.CAP_PROP_POS_MSEC, k * 1000.0 / fps):
+            if k == 0: return False
+            break
+        ok, frame = cap.read()
+        if not ok or frame is None:
+            if k == 0: return False
+            break
+        emit(k / fps, frame)
+    return True
+
+def _sample_frames_cv2(video_path: str, fps: int, emit) -> float:
+    cap = cv2.VideoCapture(video_path, cv2.CAP_FFMPEG)
     if not cap.isOpened(): raise RuntimeError("비디오를 열 수 없습니다.")
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # 한 번 훑는 파일 읽기라 내부 프레임 버퍼는 1장이면 충분
     total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
-    vid_fps = cap.get(cv2.CAP_PROP_FPS) or 25.0
-    duration_sec = (total_frames / max(vid_fps, 1e-6)) if total_frames else 0.0
+    vid_fps = max(cap.get(cv2.CAP_PROP_FPS) or 25.0, 1e-6)
+    duration_sec = (total_frames / vid_fps) if total_frames else 0.0
     step = max(int(vid_fps / max(fps, 1)), 1)
-    frames, i, t = [], 0, 0.0
+    if duration_sec > 0 and step > 1 and _seek_frames_cv2(cap, duration_sec, fps, emit):
+        cap.release()
+        return float(duration_sec)
+    # seek이 안 되는 입력(스트림/일부 코덱)은 처음부터 다시 열어 전 프레임 grab
+    cap.release()
+    cap = cv2.VideoCapture(video_path, cv2.CAP_FFMPEG)
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    i = 0
     while True:
         ret = cap.grab()
         if not ret: break
-        if i % step == 0:
+        if i % step == 0:  # 시각은 남기는 프레임에서만 계산
             ok, frame = cap.retrieve()
             if ok and frame is not None:
-                h, w = frame.shape[:2]
-                small = cv2.resize(frame, (int(w * (480 / h)), 480)) if h > 0 else frame
-                path = os.path.join(temp_dir, f"frame_{int(t)}.jpg")
-                cv2.imwrite(path, small)
-                frames.append({"path": path, "time": int(t)})
+                emit(i / vid_fps, frame)
         i += 1
-        t = i / max(vid_fps, 1e-6)
     cap.release()
+    return float(duration_sec)
+
+def extract_frames_per_second(video_path: str, fps: int = 1, dedup_bits: int = DEDUP_HAMMING,
+                              frame_size: int = FRAME_SIZE, jpeg_q: int = JPEG_QUALITY):
+    frames, pending, sizes, last_hash, prev_gray = [], [], {}, [None], [None]
+    with ThreadPoolExecutor(max_workers=ENCODE_WORKERS) as ex:
+        def emit(t, frame):
+            h, w = frame.shape[:2]
+            if h > 0 and w > 0:
+                dst = sizes.get((w, h))
+                if dst is None:  # 목표 크기는 해상도당 한 번만 계산
+                    dst = sizes[(w, h)] = _target_size(w, h, frame_size)
+                if dst != (w, h):  # PyAV 경로는 이미 디코더 쪽에서 줄여서 옴
+                    # 축소에는 INTER_AREA가 더 빠르고(SIMD 박스 필터) 앨리어싱도 적음
+                    frame = cv2.resize(frame, dst, interpolation=cv2.INTER_AREA)
+            # 직전 샘플과의 평균 절대차 = 값싼 움직임/장면전환 점수
+            gray = cv2.cvtColor(cv2.resize(frame, (160, 90), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+            motion = float(np.mean(cv2.absdiff(gray, prev_gray[0]))) if prev_gray[0] is not None else 0.0
+            prev_gray[0] = gray
+            if dedup_bits > 0:
+                # 중계 화면은 인접 프레임이 거의 같음 → Gemini로 보낼 프레임 수를 줄임
+                fh = _dhash(frame)
+                if last_hash[0] is not None and bin(fh ^ last_hash[0]).count("1") < dedup_bits:
+                    return
+                last_hash[0] = fh
+            # JPEG 인코딩은 GIL을 놓으므로 디코드와 겹쳐서 처리, 결과는 디스크 대신 메모리에
+            pending.append(ex.submit(_encode_jpeg, frame, jpeg_q))
+            frames.append({"time": int(t), "motion": motion})
+        try:
+            duration_sec = _sample_frames_av(video_path, fps, emit, frame_size)
+        except Exception:
+            # PyAV가 못 여는 입력은 기존 OpenCV 경로로
+            frames.clear(); pending.clear(); last_hash[0] = None; prev_gray[0] = None
+            duration_sec = _sample_frames_cv2(video_path, fps, emit)
+        for f, fu in zip(frames, pending):
+            f["data"] = fu.result()
     return frames, float(duration_sec)
 
+def select_candidate_frames(frames, percentile=MOTION_PERCENTILE):
+    # 사건 후보 검출을 로컬 numpy로: 움직임 점수가 상위 구간이거나 (중앙값 위의) 국소 최대인 프레임만
+    if len(frames) <= 3: return list(frames)
+    scores = np.array([f.get("motion", 0.0) for f in frames])
+    thr, med = np.percentile(scores, percentile), np.median(scores)
+    keep = []
+    for i, f in enumerate(frames):
+        sc = scores[i]
+        peak = (i == 0 or sc >= scores[i - 1]) and (i == len(frames) - 1 or sc > scores[i + 1])
+        if sc > thr or (peak and sc > med):
+            keep.append(f)
+    return keep or list(frames)
+
 def get_major_key_events(R: ResilientGemini, frames):
     if not frames: return []
     parts = [
@@ -159,11 +626,10 @@ def get_major_key_events(R: ResilientGemini, frames):
         '[{"start":초, "event_description":"..."}]\n',
         "--- 프레임 목록 ---\n",
     ]
-    for f in frames:
-        uf = R.upload_file_retry(f["path"], "image/jpeg")
-        parts.append(f"시간: {f['time']}초")
+    for t, uf in _frame_parts(R, frames):
+        parts.append(f"시간: {t}초")
         parts.append(uf)
-    js = R.generate_json_retry(parts, timeout=600)
+    js = R.generate_json_retry(parts, timeout=600, schema=EVENTS_SCHEMA)
     events, seen = [], set()
     for e in js:
         try:
@@ -181,9 +647,60 @@ def get_major_key_events(R: ResilientGemini, frames):
         events = [{"start": max(0, mid), "event_description": "주요 하이라이트"}]
     return events
 
+def _even_fill(cur, gap):
+    n = max(1, gap // 7)
+    step = gap / (1 + n)
+    return [{"start": int(round(cur["start"] + (k + 1) * step)), "event_description": "중간 하이라이트"}
+            for k in range(n)]
+
+def _gap_events(js, cur, nxt):
+    out = []
+    for e in js:
+        try:
+            st = int(round(float(e.get("start", cur["start"] + 1))))
+            desc = str(e.get("event_description", "")).strip() or "중간 하이라이트"
+        except Exception:
+            continue
+        st = max(cur["start"] + 1, min(nxt["start"] - 1, st))
+        out.append({"start": st, "event_description": desc})
+    return out
+
+def _fill_one_gap(R: ResilientGemini, cur, nxt, gap_frames):
+    parts = [
+        f"{cur['start']}초와 {nxt['start']}초 사이 공백을 메우세요.\n",
+        "5~10초 간격의 보조 사건을 JSON 배열로만:\n",
+        '[{"start":초,"event_description":"..."}]\n',
+        "--- 이 구간 프레임들 ---\n",
+    ]
+    for t, uf in _frame_parts(R, gap_frames):
+        parts.append(f"시간: {t}초")
+        parts.append(uf)
+    return _gap_events(R.generate_json_retry(parts, timeout=600, schema=EVENTS_SCHEMA), cur, nxt)
+
+def _fill_gaps_batched(R: ResilientGemini, gap_jobs):
+    # 모든 공백을 한 번의 호출로: 구간 ID(G0, G1, ...)를 키로 하는 JSON 객체를 요청
+    parts = [
+        "아래 여러 공백 구간을 각각 메우세요.\n",
+        "구간마다 5~10초 간격의 보조 사건을, 구간 ID를 키로 하는 JSON 객체 하나로만:\n",
+        '{"G0":[{"start":초,"event_description":"..."}], "G1":[...]}\n',
+    ]
+    # 인라인 예산이 요청 전체에 걸쳐 적용되도록 프레임 파트는 한 번에 만듦
+    fparts = iter(_frame_parts(R, [f for _, _, _, gf in gap_jobs for f in gf]))
+    for g, (cur, nxt, _, gap_frames) in enumerate(gap_jobs):
+        parts.append(f"--- 공백 G{g}: {cur['start']}초 → {nxt['start']}초 ---\n")
+        for _ in gap_frames:
+            t, uf = next(fparts)
+            parts.append(f"시간: {t}초")
+            parts.append(uf)
+    js = R.generate_json_retry(parts, timeout=600, schema=_gap_batch_schema(len(gap_jobs)))
+    if isinstance(js, list) and len(gap_jobs) == 1:
+        return {"G0": js}
+    return js if isinstance(js, dict) else {}
+
 def fill_gaps(R: ResilientGemini, timeline, frames, max_gap=10):
     if not timeline: return []
     out, timeline = [], sorted(timeline, key=lambda x: x["start"])
+    gap_jobs = []
     for i, cur in enumerate(timeline):
         out.append(cur)
         if i == len(timeline) - 1: break
@@ -191,78 +708,118 @@ def fill_gaps(R: ResilientGemini, timeline, frames, max_gap=10):
         if gap > max_gap:
             gap_frames = [f for f in frames if cur["start"] < f["time"] < nxt["start"]]
             if not gap_frames:
-                n, step = max(1, gap // 7), gap / (1 + max(1, gap // 7))
-                for k in range(max(1, gap // 7)):
-                    out.append({"start": int(round(cur["start"] + (k + 1) * step)), "event_description": "중간 하이라이트"})
+                out.extend(_even_fill(cur, gap))
                 continue
-            parts = [
-                f"{cur['start']}초와 {nxt['start']}초 사이 공백을 메우세요.\n",
-                "5~10초 간격의 보조 사건을 JSON 배열로만:\n",
-                '[{"start":초,"event_description":"..."}]\n',
-                "--- 이 구간 프레임들 ---\n",
-            ]
-            for f in gap_frames:
-                uf = R.upload_file_retry(f["path"], "image/jpeg")
-                parts.append(f"시간: {f['time']}초")
-                parts.append(uf)
+            gap_jobs.append((cur, nxt, gap, gap_frames))
+    if gap_jobs:
+        try:
+            batched = _fill_gaps_batched(R, gap_jobs)
+        except Exception:
+            batched = {}
+        for g, (cur, nxt, gap, gap_frames) in enumerate(gap_jobs):
+            evs = batched.get(f"G{g}")
             try:
-                js = R.generate_json_retry(parts, timeout=600)
-                for e in js:
-                    try:
-                        st = int(round(float(e.get("start", cur["start"] + 1))))
-                        desc = str(e.get("event_description", "")).strip() or "중간 하이라이트"
-                    except Exception:
-                        continue
-                    st = max(cur["start"] + 1, min(nxt["start"] - 1, st))
-                    out.append({"start": st, "event_description": desc})
+                # 배치 응답에 이 구간이 빠졌거나 형식이 틀리면 구간별 호출로 대체
+                out.extend(_gap_events(evs, cur, nxt) if isinstance(evs, list) else _fill_one_gap(R, cur, nxt, gap_frames))
             except Exception:
-                n, step = max(1, gap // 7), gap / (1 + max(1, gap // 7))
-                for k in range(max(1, gap // 7)):
-                    out.append({"start": int(round(cur["start"] + (k + 1) * step)), "event_description": "중간 하이라이트"})
-    tmp = {e["start"]: e for e in out}
-    return sorted(tmp.values(), key=lambda x: x["start"])
+                out.extend(_even_fill(cur, gap))
+    # 시작 시각이 겹치면 먼저 들어온 것(주요 사건 → 배치 응답 순)을 남김
+    result, last = [], None
+    for e in sorted(out, key=lambda x: x["start"]):
+        if e["start"] != last:
+            result.append(e)
+            last = e["start"]
+    return result
+
+def _line_from_json(i, cur, js):
+    text = str(js.get("text", "")).strip() or cur["event_description"]
+    rate = float(js.get("rate", 1.0))
+    return {"id": f"e{i}", "start": int(cur["start"]), "text": text, "rate": max(0.5, min(2.0, rate))}
+
+def _script_line(R: ResilientGemini, i, cur, available):
+    prompt = [
+        "아래 사건에 대한 해설 대사를 작성하고, 해당 길이를 주어진 시간 안에 말하기 위한 적정 배속(rate)을 계산하세요.\n",
+        'JSON 한 개: {"text":"...", "rate":숫자}\n',
+        f"사건: {cur['start']}초 - {cur['event_description']}\n",
+        f"시간제한: {float(available):.2f}초\n",
+    ]
+    try:
+        return _line_from_json(i, cur, R.generate_json_retry(prompt, timeout=180, schema=SCRIPT_LINE_SCHEMA))
+    except Exception:
+        return {"id": f"e{i}", "start": int(cur["start"]), "text": cur["event_description"], "rate": 1.0}
 
 def script_from_timeline(R: ResilientGemini, timeline):
     if not timeline: return []
-    lines = []
+    jobs = []
     for i, cur in enumerate(timeline):
         available = (timeline[i + 1]["start"] - cur["start"]) if i < len(timeline) - 1 else 8
         if available <= 0: continue
-        prompt = [
-            "아래 사건에 대한 해설 대사를 작성하고, 해당 길이를 주어진 시간 안에 말하기 위한 적정 배속(rate)을 계산하세요.\n",
-            'JSON 한 개: {"text":"...", "rate":숫자}\n',
-            f"사건: {cur['start']}초 - {cur['event_description']}\n",
-            f"시간제한: {float(available):.2f}초\n",
-        ]
+        jobs.append((i, cur, available))
+    if not jobs: return []
+    # 사건마다 따로 부르지 않고 전체 타임라인을 한 번에 요청
+    events = [{"id": f"e{i}", "start": cur["start"], "event": cur["event_description"],
+               "available_sec": round(float(available), 2)} for i, cur, available in jobs]
+    parts = [
+        "아래 각 사건에 대한 해설 대사를 작성하고, 각 대사를 available_sec 안에 말하기 위한 적정 배속(rate)을 계산하세요.\n",
+        '사건 id마다 하나씩, JSON 배열로만: [{"id":"e0","text":"...","rate":숫자}]\n',
+        "--- 사건 목록(JSON) ---\n",
+        _json_dumps(events),
+    ]
+    by_id = {}
+    try:
+        js = R.generate_json_retry(parts, timeout=600, schema=SCRIPT_BATCH_SCHEMA)
+        by_id = {str(e.get("id")): e for e in js if isinstance(e, dict)}
+    except Exception:
+        pass
+
+    def _one(job):
+        i, cur, available = job
         try:
-            js = R.generate_json_retry(prompt, timeout=180)
-            text = str(js.get("text", "")).strip() or cur["event_description"]
-            rate = float(js.get("rate", 1.0))
-            lines.append({"id": f"e{i}", "start": int(cur["start"]), "text": text, "rate": max(0.5, min(2.0, rate))})
+            return _line_from_json(i, cur, by_id[f"e{i}"])
         except Exception:
-            lines.append({"id": f"e{i}", "start": int(cur["start"]), "text": cur["event_description"], "rate": 1.0})
-    return lines
+            # 배치 응답에 빠졌거나 어긋난 사건만 사건별 호출로 (서로 독립 → 병렬, 속도는 토큰 버킷이 제한)
+            return _script_line(R, i, cur, available)
+
+    return list(_IO_POOL.map(_one, jobs))
 
 # ------------------------ TopMediaAI TTS ------------------------
 
 TOPMEDIA_TTS_API = os.environ.get("TOPMEDIA_API_URL", "https://api.topmediai.com/v1/text2speech")
 TOPMEDIA_VOICES_API = "https://api.topmediai.com/v1/voices_list"
 _SPEAKER_CACHE = None
+_SPEAKER_LOCK = threading.Lock()
+
+# TTS 라인마다 새 TCP/TLS 연결을 맺지 않도록 keep-alive 세션을 공유.
+# 일시적인 429/5xx는 어댑터 수준에서 재시도 (최종 실패는 raise_for_status가 그대로 올림)
+_SESSION = requests.Session()
+_HTTP_RETRY = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                    allowed_methods=frozenset({"GET", "POST"}), raise_on_status=False)
+_SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=_HTTP_RETRY))
+_SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=_HTTP_RETRY))
 
 def _fetch_voices(key: str):
-    r = requests.get(TOPMEDIA_VOICES_API, headers={"x-api-key": key}, timeout=60)
+    # 작업마다 프로세스가 새로 떠서 메모리 캐시가 안 남음 → 디스크 캐시(TTL)로 voices_list 왕복을 건너뜀
+    cache_key = _hash_key({"api": urlparse(TOPMEDIA_VOICES_API).netloc, "key": key})
+    cached = cache_get("voices", cache_key)
+    if cached is not None:
+        return _json_loads(cached)
+    r = _SESSION.get(TOPMEDIA_VOICES_API, headers={"x-api-key": key}, timeout=60)
     r.raise_for_status()
+    voices = []
     if "application/json" in (r.headers.get("content-type") or ""):
         j = r.json()
-        return (j.get("Voice") or []) if isinstance(j, dict) else []
-    return []
+        voices = (j.get("Voice") or []) if isinstance(j, dict) else []
+    if voices:
+        cache_set("voices", cache_key, _json_dumpb(voices))
+    return voices
 
 def resolve_speaker_id(desired: Optional[str], key: str) -> str:
     global _SPEAKER_CACHE
     if desired and isinstance(desired, str) and "-" in desired and len(desired) >= 8:
         return desired
-    if _SPEAKER_CACHE is None:
-        _SPEAKER_CACHE = _fetch_voices(key)
+    with _SPEAKER_LOCK:  # 병렬 TTS 호출이 voices_list를 중복 조회하지 않도록
+        if _SPEAKER_CACHE is None:
+            _SPEAKER_CACHE = _fetch_voices(key)
     if desired:
         for v in _SPEAKER_CACHE or []:
             if str(v.get("urlname", "")).lower() == desired.lower() or str(v.get("name", "")).lower() == desired.lower():
@@ -274,6 +831,12 @@ def resolve_speaker_id(desired: Optional[str], key: str) -> str:
         return _SPEAKER_CACHE[0].get("speaker") or _SPEAKER_CACHE[0].get("modeltoken") or ""
     raise RuntimeError("TopMediai voices not available")
 
+def _download_audio(u: str) -> bytes:
+    # 청크 단위로 받아 붙이고, with로 닫아서 연결을 바로 세션 풀에 돌려줌
+    with _SESSION.get(u, timeout=120, stream=True) as r2:
+        r2.raise_for_status()
+        return b"".join(r2.iter_content(chunk_size=64 * 1024))
+
 def _find_audio_in_json(j: dict) -> Optional[bytes]:
     def _find_url(d: dict) -> Optional[str]:
         for k in ("url", "oss_url", "audio_url", "oss_audio_url", "audioUrl"):
@@ -287,9 +850,7 @@ def _find_audio_in_json(j: dict) -> Optional[bytes]:
 
     u = _find_url(j)
     if u:
-        r2 = requests.get(u, timeout=120)
-        r2.raise_for_status()
-        return r2.content
+        return _download_audio(u)
 
     for k in ("audio", "audioContent", "audio_base64", "audioBase64"):
         b64 = j.get(k)
@@ -300,9 +861,7 @@ def _find_audio_in_json(j: dict) -> Optional[bytes]:
     if isinstance(data, dict):
         u = _find_url(data)
         if u:
-            r2 = requests.get(u, timeout=120)
-            r2.raise_for_status()
-            return r2.content
+            return _download_audio(u)
         for k in ("audio", "audioContent", "audio_base64", "audioBase64"):
             b64 = data.get(k)
             if isinstance(b64, str) and b64:
@@ -314,9 +873,7 @@ def _find_audio_in_json(j: dict) -> Optional[bytes]:
                 continue
             u = _find_url(item)
             if u:
-                r2 = requests.get(u, timeout=120)
-                r2.raise_for_status()
-                return r2.content
+                return _download_audio(u)
             for k in ("audio", "audioContent", "audio_base64", "audioBase64"):
                 b64 = item.get(k)
                 if isinstance(b64, str) and b64:
@@ -328,11 +885,20 @@ def topmedia_speak(text: str, voice: str) -> bytes:
     key = os.environ.get("TOPMEDIA_API_KEY", "")
     if not key:
         raise RuntimeError("TOPMEDIA_API_KEY missing")
+    cache_key = _hash_key({"api": TOPMEDIA_TTS_API, "voice": voice, "text": text})
+    cached = cache_get("tts", cache_key)
+    if cached is not None:
+        return cached
+    audio = _topmedia_request(text, voice, key)
+    cache_set("tts", cache_key, audio)
+    return audio
+
+def _topmedia_request(text: str, voice: str, key: str) -> bytes:
     speaker = resolve_speaker_id(voice, key)
     payload = {"text": text, "speaker": speaker, "emotion": "Neutral"}
     headers = {"Content-Type": "application/json", "x-api-key": key}
 
-    r = requests.post(TOPMEDIA_TTS_API, headers=headers, json=payload, timeout=120)
+    r = _SESSION.post(TOPMEDIA_TTS_API, headers=headers, json=payload, timeout=120)
     r.raise_for_status()
 
     ct = r.headers.get("content-type", "") or ""
@@ -350,21 +916,46 @@ def topmedia_speak(text: str, voice: str) -> bytes:
 
     return r.content
 
+TTS_SAMPLE_RATE = 44100
+
+def _decode_mp3_pcm(audio: bytes, sr: int = TTS_SAMPLE_RATE) -> np.ndarray:
+    # pydub(임시 파일 + 파이썬 쪽 리샘플) 대신 ffmpeg 한 번으로 mono s16le 디코드/리샘플
+    p = subprocess.run(
+        ["ffmpeg", "-loglevel", "error", "-f", "mp3", "-i", "pipe:0",
+         "-f", "s16le", "-ac", "1", "-ar", str(sr), "pipe:1"],
+        input=audio, capture_output=True, check=True,
+    )
+    return np.frombuffer(p.stdout, dtype=np.int16)
+
 def synthesize_timeline_mp3(lines, out_path: str, voice: str):
-    segments, max_end_ms = [], 0
-    from io import BytesIO
-    for ln in lines:
+    sr = TTS_SAMPLE_RATE
+
+    def _render(ln):
         audio = topmedia_speak(ln["text"], voice)
-        seg = AudioSegment.from_file(BytesIO(audio), format="mp3")
-        start_ms = int(ln["start"] * 1000)
-        segments.append((start_ms, seg))
-        max_end_ms = max(max_end_ms, start_ms + len(seg))
+        return int(ln["start"] * 1000) * sr // 1000, _decode_mp3_pcm(audio, sr)
+
+    # TTS 요청과 mp3 디코드(ffmpeg 서브프로세스)는 라인끼리 독립 → 동시에 처리하고 믹싱만 순서대로
+    segments = list(_IO_POOL.map(_render, lines))
     if not segments:
         raise RuntimeError("no TTS segments")
-    timeline = AudioSegment.silent(duration=max_end_ms + 1000)
-    for start_ms, seg in segments:
-        timeline = timeline.overlay(seg, position=start_ms)
-    timeline.export(out_path, format="mp3")
+    # 라인마다 타임라인 전체를 복사하는 overlay 대신 int32 버퍼 하나에 numpy로 더하고 한 번만 인코딩
+    total = max(i + len(pcm) for i, pcm in segments) + sr  # 끝에 1초 여유
+    ordered = sorted(segments, key=lambda x: x[0])
+    if any(a + len(pa) > b for (a, pa), (b, _) in zip(ordered, ordered[1:])):
+        mix = np.zeros(total, dtype=np.int32)
+        for i, pcm in ordered:
+            mix[i:i + len(pcm)] += pcm
+        out = np.clip(mix, -32768, 32767).astype(np.int16)
+    else:
+        # 대사끼리 안 겹치면(보통의 경우) 더하기/클리핑 없이 int16 버퍼에 그대로 복사
+        out = np.zeros(total, dtype=np.int16)
+        for i, pcm in ordered:
+            out[i:i + len(pcm)] = pcm
+    subprocess.run(
+        ["ffmpeg", "-y", "-loglevel", "error", "-f", "s16le", "-ar", str(sr), "-ac", "1",
+         "-i", "pipe:0", "-f", "mp3", out_path],
+        input=out.tobytes(), capture_output=True, check=True,
+    )
     return out_path
 
 # ------------------------ main ------------------------
@@ -375,6 +966,8 @@ def main():
     ap.add_argument("--outdir", required=True)
     ap.add_argument("--fps", type=int, default=1)
     ap.add_argument("--max_gap", type=int, default=10)
+    ap.add_argument("--frame_size", type=int, default=FRAME_SIZE)  # Gemini로 보내는 프레임 짧은 변(px)
+    ap.add_argument("--jpeg_q", type=int, default=JPEG_QUALITY)
     ap.add_argument("--model", default="gemini-1.5-pro-latest")
     ap.add_argument("--voiceId", default=os.environ.get("TOPMEDIA_VOICE", "ko_female_basic"))
     ap.add_argument("--lines_path")  # ← 라인 JSON 주면 재합성만
@@ -382,26 +975,27 @@ def main():
 
     os.makedirs(args.outdir, exist_ok=True)
     out_json = os.path.join(args.outdir, "result.json")
-    write_json_atomic(out_json, {"status": "started"})
+    write_json(out_json, {"status": "started"})
 
     try:
         # 재합성 모드: lines만 가지고 TTS 만들기
         if args.lines_path:
             if not os.path.exists(args.lines_path):
                 raise RuntimeError("lines_path not found")
-            with open(args.lines_path, "r", encoding="utf-8") as f:
-                lines = json.load(f)
+            with open(args.lines_path, "rb") as f:
+                lines = _json_loads(f.read())
             tts_path = os.path.join(args.outdir, "tts.mp3")
             synthesize_timeline_mp3(lines, tts_path, voice=args.voiceId)
             base = {}
             if os.path.exists(out_json):
                 try:
-                    base = json.load(open(out_json, "r", encoding="utf-8"))
+                    with open(out_json, "rb") as f:
+                        base = _json_loads(f.read())
                 except Exception:
                     base = {}
             base.update({"status": "done", "tts_path": tts_path})
             write_json_atomic(out_json, base)
-            print(json.dumps(base, ensure_ascii=False), flush=True)
+            _print_json(base)
             return
 
         # 분석 모드(비전 + 제미니 + TTS)
@@ -413,10 +1007,14 @@ def main():
 
         R = ResilientGemini(api_key=gemini_key, model_name=args.model, default_timeout=180)
 
-        frames, duration = extract_frames_per_second(args.video, fps=args.fps)
-        timeline = get_major_key_events(R, frames)
-        timeline = fill_gaps(R, timeline, frames, max_gap=args.max_gap)
-        lines = script_from_timeline(R, timeline)
+        frames, duration = extract_frames_per_second(args.video, fps=args.fps,
+                                                     frame_size=args.frame_size, jpeg_q=args.jpeg_q)
+        try:
+            timeline = get_major_key_events(R, select_candidate_frames(frames))
+            timeline = fill_gaps(R, timeline, frames, max_gap=args.max_gap)
+            lines = script_from_timeline(R, timeline)
+        finally:
+            R.delete_uploads()  # 실패해도 업로드한 프레임은 정리
         script_text = "\n".join([l["text"] for l in lines])
 
         tts_path = os.path.join(args.outdir, "tts.mp3")
@@ -431,13 +1029,13 @@ def main():
             "tts_path": tts_path,
         }
         write_json_atomic(out_json, out)
-        print(json.dumps(out, ensure_ascii=False), flush=True)
+        _print_json(out)
 
     except Exception as e:
         import traceback
         err = {"status": "error", "message": str(e), "trace": traceback.format_exc()}
         write_json_atomic(out_json, err)
-        print(json.dumps(err, ensure_ascii=False), flush=True)
+        _print_json(err)
         sys.exit(1)
 
 if __name__ == "__main__":